@@ -2,218 +2,83 @@
 # Autor: Shinsei API
 # Versão: 2.0 - Com Detector de Anomalias
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
-import numpy as np
-from sklearn.ensemble import IsolationForest
-from typing import List, Dict, Any
+import orjson
+from typing import Any
 import logging
+import os
+import threading
 
-# Configurar logging
-logging.basicConfig(level=logging.INFO)
+from detector_anomalias import DetectorAnomalias, DetectorAnomaliasPorCliente
+
+# Configurar logging (em produção, LOG_LEVEL=WARNING omite os logs INFO).
+# Um nível desconhecido não impede a API de subir: cai para INFO com aviso
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_LEVEL_VALIDO = LOG_LEVEL in logging.getLevelNamesMapping()
+logging.basicConfig(level=LOG_LEVEL if LOG_LEVEL_VALIDO else logging.INFO)
 logger = logging.getLogger(__name__)
+if not LOG_LEVEL_VALIDO:
+    logger.warning("LOG_LEVEL desconhecido (%s); usando INFO", LOG_LEVEL)
 
-# Inicializa a aplicação Flask
-app = Flask(__name__)
-CORS(app)  # Permite requisições do HostGator
 
-# ============================================================
-# CLASSE: DETECTOR DE ANOMALIAS
-# ============================================================
+ORJSON_OPCOES = orjson.OPT_NON_STR_KEYS | orjson.OPT_SORT_KEYS | orjson.OPT_SERIALIZE_NUMPY
 
-class DetectorAnomalias:
-    """
-    Detector de valores anômalos em cargas de transporte.
-    Usa algoritmo Isolation Forest para identificar valores suspeitos.
-    """
-    
-    def __init__(self, contaminacao=0.15):
-        """
-        Args:
-            contaminacao: Percentual esperado de anomalias (padrão: 15%)
-        """
-        self.modelo = IsolationForest(
-            contamination=contaminacao,
-            random_state=42,
-            n_estimators=100
-        )
-        
-    def analisar_cargas(self, cargas: List[Dict[str, Any]]) -> Dict[str, Any]:
-        """
-        Analisa lista de cargas e identifica anomalias
-        
-        Args:
-            cargas: Lista de dicionários com dados das cargas
-            
-        Returns:
-            Dicionário com resultados da análise
-        """
-        # Validação mínima
-        if not cargas or len(cargas) < 3:
-            return {
-                'anomalias': [],
-                'estatisticas': None,
-                'aviso': 'Número insuficiente de cargas para análise (mínimo 3)'
-            }
-        
-        try:
-            # Extrair valores
-            valores = np.array([float(c.get('CARGAS_VALOR', 0)) for c in cargas])
-            valores = valores.reshape(-1, 1)
-            
-            # Calcular estatísticas
-            estatisticas = self._calcular_estatisticas(valores.flatten())
-            
-            # Detectar anomalias
-            predicoes = self.modelo.fit_predict(valores)
-            scores = self.modelo.score_samples(valores)
-            
-            # Identificar cargas anômalas
-            anomalias = []
-            for i, (predicao, score) in enumerate(zip(predicoes, scores)):
-                if predicao == -1:  # -1 = anomalia
-                    carga = cargas[i]
-                    valor = float(carga.get('CARGAS_VALOR', 0))
-                    
-                    tipo_anomalia = self._classificar_anomalia(valor, estatisticas)
-                    severidade = self._calcular_severidade(score, scores)
-                    
-                    anomalias.append({
-                        'id': carga.get('ID_CARGAS'),
-                        'veiculo': carga.get('CARGAS_VEICULO', 'N/A'),
-                        'chassis': carga.get('CARGAS_CHASSIS', 'N/A'),
-                        'valor': valor,
-                        'tipo': tipo_anomalia,
-                        'severidade': severidade,
-                        'score_anomalia': float(score),
-                        'sugestao': self._gerar_sugestao(valor, estatisticas, tipo_anomalia),
-                        'valor_esperado': int(estatisticas['mediana'])
-                    })
-            
-            return {
-                'anomalias': anomalias,
-                'estatisticas': estatisticas,
-                'total_cargas': len(cargas),
-                'total_anomalias': len(anomalias),
-                'percentual_anomalias': round((len(anomalias) / len(cargas)) * 100, 2)
-            }
-            
-        except Exception as e:
-            logger.error(f"Erro ao analisar cargas: {str(e)}")
-            return {
-                'anomalias': [],
-                'estatisticas': None,
-                'erro': str(e)
-            }
-    
-    def _calcular_estatisticas(self, valores: np.ndarray) -> Dict[str, float]:
-        """Calcula estatísticas descritivas dos valores"""
-        return {
-            'media': int(np.mean(valores)),
-            'mediana': int(np.median(valores)),
-            'desvio_padrao': int(np.std(valores)),
-            'minimo': int(np.min(valores)),
-            'maximo': int(np.max(valores)),
-            'q1': int(np.percentile(valores, 25)),
-            'q3': int(np.percentile(valores, 75)),
-            'iqr': int(np.percentile(valores, 75) - np.percentile(valores, 25))
-        }
+
+class OrjsonProvider(JSONProvider):
+    """Provider JSON do Flask baseado em orjson (parse e serialização mais rápidos)"""
     
-    def _classificar_anomalia(self, valor: float, stats: Dict[str, float]) -> str:
-        """Classifica o tipo de anomalia"""
-        if valor > stats['q3'] + (1.5 * stats['iqr']):
-            if valor > stats['media'] * 2:
-                return 'MUITO_ALTO'
-            return 'ALTO'
-        elif valor < stats['q1'] - (1.5 * stats['iqr']):
-            if valor < stats['media'] * 0.5:
-                return 'MUITO_BAIXO'
-            return 'BAIXO'
-        return 'OUTLIER'
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return orjson.dumps(obj, option=ORJSON_OPCOES).decode('utf-8')
     
-    def _calcular_severidade(self, score: float, todos_scores: np.ndarray) -> int:
-        """Calcula severidade de 0-100 (100 = mais suspeito)"""
-        min_score = np.min(todos_scores)
-        max_score = np.max(todos_scores)
-        
-        if max_score == min_score:
-            return 50
-        
-        # Inverter: scores mais negativos = maior severidade
-        severidade = 100 - ((score - min_score) / (max_score - min_score) * 100)
-        return int(severidade)
+    def loads(self, s: Any, **kwargs: Any) -> Any:
+        return orjson.loads(s)
     
-    def _gerar_sugestao(self, valor: float, stats: Dict[str, float], tipo: str) -> str:
-        """Gera sugestão de ação"""
-        sugestoes = {
-            'MUITO_ALTO': f"Valor ¥{valor:,.0f} está muito acima da média (¥{stats['media']:,.0f}). Verifique se não há zeros extras.",
-            'ALTO': f"Valor ¥{valor:,.0f} está acima do esperado (¥{stats['mediana']:,.0f}). Confirme se está correto.",
-            'MUITO_BAIXO': f"Valor ¥{valor:,.0f} está muito abaixo da média (¥{stats['media']:,.0f}). Verifique se não faltam dígitos.",
-            'BAIXO': f"Valor ¥{valor:,.0f} está abaixo do esperado (¥{stats['mediana']:,.0f}). Confirme se está correto.",
-            'OUTLIER': f"Valor ¥{valor:,.0f} é incomum. Valor típico é ¥{stats['mediana']:,.0f}."
-        }
-        return sugestoes.get(tipo, "Verifique este valor.")
+    def response(self, *args: Any, **kwargs: Any) -> Response:
+        # jsonify: usa os bytes do orjson direto, sem decodificar para str
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, option=ORJSON_OPCOES),
+            mimetype='application/json'
+        )
 
 
-class DetectorAnomaliasPorCliente:
-    """Detector que considera histórico do cliente"""
-    
-    def __init__(self):
-        self.detector_base = DetectorAnomalias()
-    
-    def analisar_com_historico(
-        self, 
-        cargas_atuais: List[Dict[str, Any]], 
-        historico_cliente: List[Dict[str, Any]] = None
-    ) -> Dict[str, Any]:
-        """Analisa cargas considerando histórico do cliente"""
-        # Análise básica
-        resultado_atual = self.detector_base.analisar_cargas(cargas_atuais)
-        
-        # Se tiver histórico suficiente, fazer comparação adicional
-        if historico_cliente and len(historico_cliente) >= 10:
-            try:
-                valores_historicos = [float(h.get('CARGAS_VALOR', 0)) for h in historico_cliente]
-                stats_historico = {
-                    'media_historica': int(np.mean(valores_historicos)),
-                    'mediana_historica': int(np.median(valores_historicos)),
-                    'max_historico': int(np.max(valores_historicos)),
-                    'min_historico': int(np.min(valores_historicos))
-                }
-                
-                # Verificar valores muito fora do histórico
-                for carga in cargas_atuais:
-                    valor = float(carga.get('CARGAS_VALOR', 0))
-                    
-                    # Se valor é 2x maior que máximo histórico
-                    if valor > stats_historico['max_historico'] * 2:
-                        ja_detectado = any(
-                            a['id'] == carga.get('ID_CARGAS') 
-                            for a in resultado_atual['anomalias']
-                        )
-                        
-                        if not ja_detectado:
-                            resultado_atual['anomalias'].append({
-                                'id': carga.get('ID_CARGAS'),
-                                'veiculo': carga.get('CARGAS_VEICULO', 'N/A'),
-                                'valor': valor,
-                                'tipo': 'FORA_DO_HISTORICO',
-                                'severidade': 90,
-                                'sugestao': f"Valor ¥{valor:,.0f} é 2x maior que máximo histórico (¥{stats_historico['max_historico']:,.0f})",
-                                'valor_esperado': stats_historico['media_historica']
-                            })
-                
-                resultado_atual['comparacao_historico'] = stats_historico
-                
-            except Exception as e:
-                logger.error(f"Erro ao processar histórico: {str(e)}")
-        
-        return resultado_atual
+# Inicializa a aplicação Flask
+app = Flask(__name__)
+app.json = OrjsonProvider(app)  # request.get_json() e jsonify passam a usar orjson
+CORS(app)  # Permite requisições do HostGator
+
+# Status de entrega convertidos em índices inteiros no relatório
+STATUS_ENTREGUE = 0
+STATUS_PENDENTE = 1
+STATUS_CANCELADO = 2
+STATUS_OUTRO = 3  # Status ausente ou desconhecido
+STATUS_TAGS = {
+    'entregue': STATUS_ENTREGUE,
+    'pendente': STATUS_PENDENTE,
+    'cancelado': STATUS_CANCELADO
+}
+
+# Instanciar detectores globalmente. DETECTOR_BACKEND escolhe a implementação
+# do Isolation Forest: 'sklearn' (padrão) ou 'isotree'
+DETECTOR_BACKEND = os.environ.get('DETECTOR_BACKEND', 'sklearn')
 
+# Quantos ajustes do modelo (cada um em uma única thread) rodam ao mesmo tempo
+# neste processo. O limite é por processo: com vários workers do gunicorn,
+# ANALISE_THREADS x workers deve ficar próximo do número de CPUs
+ANALISE_THREADS = int(os.environ.get('ANALISE_THREADS', 1))
+LIMITE_AJUSTES = threading.BoundedSemaphore(ANALISE_THREADS)
 
-# Instanciar detectores globalmente
-detector = DetectorAnomalias(contaminacao=0.15)
-detector_cliente = DetectorAnomaliasPorCliente()
+detector = DetectorAnomalias(
+    contaminacao=0.15,
+    backend=DETECTOR_BACKEND,
+    limite_ajustes=LIMITE_AJUSTES
+)
+detector_cliente = DetectorAnomaliasPorCliente(
+    backend=DETECTOR_BACKEND,
+    limite_ajustes=LIMITE_AJUSTES
+)
 
 
 # ============================================================
@@ -277,19 +142,26 @@ def relatorio():
     # Calcula as estatísticas
     total_entregas = len(entregas)
 
-    # Conta entregas por status
-    entregues = sum(1 for e in entregas if e.get('status') == 'entregue')
-    pendentes = sum(1 for e in entregas if e.get('status') == 'pendente')
-    canceladas = sum(1 for e in entregas if e.get('status') == 'cancelado')
-
-    # Calcula valor total das entregas
-    valor_total = sum(e.get('valor', 0) for e in entregas)
+    # Conta entregas por status e soma os valores em uma única passada
+    contagem = [0] * (len(STATUS_TAGS) + 1)
+    valor_total = 0.0
+    valor_entregue = 0.0
+    try:
+        for e in entregas:
+            tag = STATUS_TAGS.get(e.get('status'), STATUS_OUTRO)
+            contagem[tag] += 1
+            v = float(e.get('valor', 0) or 0)
+            valor_total += v
+            if tag == STATUS_ENTREGUE:
+                valor_entregue += v
+    except (TypeError, ValueError):
+        return jsonify({
+            'erro': 'Dados inválidos. O campo valor das entregas deve ser numérico.'
+        }), 400
 
-    # Calcula valor das entregas concluídas
-    valor_entregue = sum(
-        e.get('valor', 0) for e in entregas
-        if e.get('status') == 'entregue'
-    )
+    entregues = contagem[STATUS_ENTREGUE]
+    pendentes = contagem[STATUS_PENDENTE]
+    canceladas = contagem[STATUS_CANCELADO]
 
     # Monta o relatório de estatísticas
     estatisticas = {
@@ -353,12 +225,12 @@ def detectar_anomalias():
                 'erro': 'Cargas deve ser uma lista'
             }), 400
         
-        logger.info(f"Analisando {len(cargas)} cargas...")
+        logger.info("Analisando %d cargas...", len(cargas))
         
         # Realizar análise
         resultado = detector.analisar_cargas(cargas)
         
-        logger.info(f"Encontradas {len(resultado.get('anomalias', []))} anomalias")
+        logger.info("Encontradas %d anomalias", len(resultado.get('anomalias', [])))
         
         return jsonify({
             'sucesso': True,
@@ -366,7 +238,7 @@ def detectar_anomalias():
         })
         
     except Exception as e:
-        logger.error(f"Erro ao detectar anomalias: {str(e)}")
+        logger.error("Erro ao detectar anomalias: %s", e)
         return jsonify({
             'sucesso': False,
             'erro': str(e)
@@ -396,12 +268,12 @@ def detectar_anomalias_historico():
         cargas = dados['cargas']
         historico = dados.get('historico', [])
         
-        logger.info(f"Analisando {len(cargas)} cargas com histórico de {len(historico)} registros...")
+        logger.info("Analisando %d cargas com histórico de %d registros...", len(cargas), len(historico))
         
         # Realizar análise com histórico
         resultado = detector_cliente.analisar_com_historico(cargas, historico)
         
-        logger.info(f"Encontradas {len(resultado.get('anomalias', []))} anomalias")
+        logger.info("Encontradas %d anomalias", len(resultado.get('anomalias', [])))
         
         return jsonify({
             'sucesso': True,
@@ -409,14 +281,15 @@ def detectar_anomalias_historico():
         })
         
     except Exception as e:
-        logger.error(f"Erro: {str(e)}")
+        logger.error("Erro: %s", e)
         return jsonify({
             'sucesso': False,
             'erro': str(e)
         }), 500
 
 
-# Executa a aplicação
+# Executa a aplicação (servidor de desenvolvimento).
+# Em produção: gunicorn -w 4 -k gthread --threads 8 app:app (ver README)
 if __name__ == '__main__':
     logger.info("Iniciando Shinsei Logistics API v2.0...")
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -4,25 +4,98 @@ Detecta valores suspeitos em cargas antes de gerar faturas
 """
 
 import numpy as np
-import pandas as pd
+from sklearn.base import clone
 from sklearn.ensemble import IsolationForest
-from typing import List, Dict, Any
+from contextlib import nullcontext
+from typing import List, Dict, Any, Optional, Tuple
+import logging
+import threading
+
+try:
+    import isotree  # Backend alternativo (C++), escolhido com backend='isotree'
+except ImportError:
+    isotree = None
+
+logger = logging.getLogger(__name__)
+
+# Implementações do Isolation Forest disponíveis
+BACKEND_SKLEARN = 'sklearn'
+BACKEND_ISOTREE = 'isotree'
+BACKENDS = (BACKEND_SKLEARN, BACKEND_ISOTREE)
+
+# Limites de árvores do Isolation Forest (ajustado ao tamanho do lote)
+N_ESTIMADORES_MIN = 20
+N_ESTIMADORES_MAX = 100
+
+# Abaixo deste número de cargas usa-se a regra do IQR em vez do modelo
+MIN_CARGAS_MODELO = 20
+
+# Variação relativa (desvio/média) abaixo da qual os valores são tratados
+# como constantes e também seguem a regra do IQR
+VARIACAO_MINIMA = 1e-3
+
+# Amostras por árvore (teto padrão do Isolation Forest)
+MAX_AMOSTRAS = 256
+
+# Capacidade do buffer reaproveitado para a entrada do modelo
+TAMANHO_BUFFER = 4096
+
+# Textos de sugestão por tipo de anomalia ({valor}, {media} e {mediana}
+# já chegam formatados em ienes)
+SUGESTOES = {
+    'MUITO_ALTO': "Valor {valor} está muito acima da média ({media}). Verifique se não há zeros extras.",
+    'ALTO': "Valor {valor} está acima do esperado ({mediana}). Confirme se está correto.",
+    'MUITO_BAIXO': "Valor {valor} está muito abaixo da média ({media}). Verifique se não faltam dígitos.",
+    'BAIXO': "Valor {valor} está abaixo do esperado ({mediana}). Confirme se está correto.",
+    'OUTLIER': "Valor {valor} é incomum. Valor típico é {mediana}."
+}
+
 
 class DetectorAnomalias:
     """
-    Classe para detectar valores anômalos em cargas de transporte
+    Detector de valores anômalos em cargas de transporte.
+    Usa algoritmo Isolation Forest para identificar valores suspeitos.
     """
     
-    def __init__(self, contaminacao=0.1):
+    def __init__(
+        self,
+        contaminacao=0.15,
+        backend=BACKEND_SKLEARN,
+        limite_ajustes: Optional[threading.Semaphore] = None
+    ):
         """
         Args:
-            contaminacao: Percentual esperado de anomalias (padrão: 10%)
+            contaminacao: Percentual esperado de anomalias (padrão: 15%)
+            backend: Implementação do Isolation Forest, 'sklearn' (padrão)
+                ou 'isotree'
+            limite_ajustes: Semáforo compartilhado que limita os ajustes do
+                modelo simultâneos (opcional; a regra do IQR não o usa)
         """
-        self.modelo = IsolationForest(
-            contamination=contaminacao,
-            random_state=42,
-            n_estimators=100
-        )
+        if backend not in BACKENDS:
+            raise ValueError(f"Backend inválido: {backend!r} (use um de {BACKENDS})")
+        if backend == BACKEND_ISOTREE and isotree is None:
+            raise ImportError(
+                "Backend 'isotree' escolhido, mas o pacote isotree não está instalado "
+                "(pip install -r requirements-isotree.txt)"
+            )
+        
+        self.contaminacao = contaminacao
+        self.backend = backend
+        # Estimador de referência, clonado a cada análise (só no backend sklearn)
+        self.modelo = None
+        if backend == BACKEND_SKLEARN:
+            self.modelo = IsolationForest(
+                contamination=contaminacao,
+                random_state=42,
+                n_estimators=N_ESTIMADORES_MAX,
+                max_samples=MAX_AMOSTRAS,
+                max_features=1.0,
+                bootstrap=False
+            )
+        logger.info("Detector de anomalias usando o backend %s", backend)
+        self._limite_ajustes = limite_ajustes or nullcontext()
+        # Buffer float32 de entrada do modelo, um por thread
+        self._local = threading.local()
         
     def analisar_cargas(self, cargas: List[Dict[str, Any]]) -> Dict[str, Any]:
         """
@@ -34,6 +107,7 @@ class DetectorAnomalias:
         Returns:
             Dicionário com resultados da análise
         """
+        # Validação mínima
         if not cargas or len(cargas) < 3:
             return {
                 'anomalias': [],
@@ -41,65 +115,174 @@ class DetectorAnomalias:
                 'aviso': 'Número insuficiente de cargas para análise (mínimo 3)'
             }
         
-        # Extrair valores e converter para array
-        valores = np.array([float(c.get('CARGAS_VALOR', 0)) for c in cargas])
-        valores = valores.reshape(-1, 1)
-        
-        # Calcular estatísticas básicas
-        estatisticas = self._calcular_estatisticas(valores.flatten())
-        
-        # Detectar anomalias usando Isolation Forest
-        predicoes = self.modelo.fit_predict(valores)
-        scores = self.modelo.score_samples(valores)
-        
-        # Identificar cargas anômalas
-        anomalias = []
-        for i, (predicao, score) in enumerate(zip(predicoes, scores)):
-            if predicao == -1:  # -1 indica anomalia
+        try:
+            # Extrair valores
+            valores = np.fromiter(
+                (float(c.get('CARGAS_VALOR', 0) or 0) for c in cargas),
+                dtype=np.float64,
+                count=len(cargas)
+            )
+            
+            # Calcular estatísticas (inteiras para a resposta; as brutas, em
+            # float, alimentam as cercas do IQR e a classificação)
+            estatisticas, brutas = self._calcular_estatisticas(valores)
+            
+            # Detectar anomalias. Lotes pequenos ou sem variação não dão sinal
+            # estatístico ao Isolation Forest: basta a regra do IQR
+            if len(valores) < MIN_CARGAS_MODELO or self._sem_variacao(brutas):
+                metodo = 'iqr'
+                scores, predicoes = self._pontuar_iqr(valores, brutas)
+                severidades = self._calcular_severidades_iqr(scores)
+            else:
+                metodo = f'isolation_forest_{self.backend}'
+                # As árvores do scikit-learn trabalham em float32: converter uma
+                # única vez (no buffer reaproveitado da thread) evita a conversão
+                # repetida em fit e score_samples
+                matriz = self._buffer_float32(len(valores))
+                matriz[:] = valores
+                with self._limite_ajustes:
+                    scores, predicoes = self._pontuar(matriz.reshape(-1, 1))
+                severidades = self._calcular_severidades(scores)
+            
+            # Identificar cargas anômalas (-1 = anomalia); só as anômalas
+            # chegam ao laço Python
+            indices = np.flatnonzero(predicoes == -1)
+            
+            referencias = self._formatar_referencias(estatisticas)
+            
+            anomalias = []
+            for i in indices:
                 carga = cargas[i]
-                valor = float(carga.get('CARGAS_VALOR', 0))
-                
-                # Determinar tipo de anomalia
-                tipo_anomalia = self._classificar_anomalia(valor, estatisticas)
+                valor = float(valores[i])
                 
-                # Calcular severidade (0-100)
-                severidade = self._calcular_severidade(score, scores)
+                tipo_anomalia = self._classificar_anomalia(valor, brutas)
                 
                 anomalias.append({
                     'id': carga.get('ID_CARGAS'),
-                    'veiculo': carga.get('CARGAS_VEICULO'),
-                    'chassis': carga.get('CARGAS_CHASSIS'),
+                    'veiculo': carga.get('CARGAS_VEICULO', 'N/A'),
+                    'chassis': carga.get('CARGAS_CHASSIS', 'N/A'),
                     'valor': valor,
                     'tipo': tipo_anomalia,
-                    'severidade': severidade,
-                    'score_anomalia': float(score),
-                    'sugestao': self._gerar_sugestao(valor, estatisticas, tipo_anomalia),
-                    'valor_esperado': estatisticas['mediana']
+                    'severidade': int(severidades[i]),
+                    'score_anomalia': float(scores[i]),
+                    'sugestao': self._gerar_sugestao(valor, referencias, tipo_anomalia),
+                    'valor_esperado': int(estatisticas['mediana'])
                 })
+            
+            return {
+                'anomalias': anomalias,
+                'estatisticas': estatisticas,
+                'total_cargas': len(cargas),
+                'total_anomalias': len(anomalias),
+                'percentual_anomalias': round((len(anomalias) / len(cargas)) * 100, 2),
+                'metodo': metodo
+            }
+            
+        except Exception as e:
+            logger.error("Erro ao analisar cargas: %s", e)
+            return {
+                'anomalias': [],
+                'estatisticas': None,
+                'erro': str(e)
+            }
+    
+    def _buffer_float32(self, n: int) -> np.ndarray:
+        """Retorna n posições do buffer float32 da thread (ou um array novo, se não couber)"""
+        buffer = getattr(self._local, 'buffer', None)
+        if buffer is None:
+            buffer = np.empty(TAMANHO_BUFFER, dtype=np.float32)
+            self._local.buffer = buffer
+        if n > buffer.size:
+            return np.empty(n, dtype=np.float32)
+        return buffer[:n]
+    
+    def _pontuar(self, matriz: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Ajusta o modelo e pontua as cargas.
         
-        return {
-            'anomalias': anomalias,
-            'estatisticas': estatisticas,
-            'total_cargas': len(cargas),
-            'total_anomalias': len(anomalias),
-            'percentual_anomalias': round((len(anomalias) / len(cargas)) * 100, 2)
-        }
+        Returns:
+            (scores, predicoes) no padrão do scikit-learn: scores menores
+            = mais anômalos, predição -1 = anomalia
+        """
+        n_arvores = self._n_estimadores(len(matriz))
+        
+        if self.backend == BACKEND_ISOTREE:
+            modelo = isotree.IsolationForest(
+                ntrees=n_arvores,
+                ndim=1,
+                sample_size=min(MAX_AMOSTRAS, len(matriz)),
+                nthreads=1,
+                random_seed=42
+            )
+            modelo.fit(matriz)
+            # isotree: score maior = mais anômalo; inverter para o padrão sklearn
+            scores = -modelo.predict(matriz, output='score')
+            # Mesmo corte por contaminação que o IsolationForest do sklearn
+            limite = np.percentile(scores, 100.0 * self.contaminacao)
+            return scores, np.where(scores < limite, -1, 1)
+        
+        # Cada análise ajusta sua própria cópia do modelo, para que
+        # requisições simultâneas não disputem o mesmo estimador
+        modelo = clone(self.modelo).set_params(
+            n_estimators=n_arvores,
+            max_samples=min(MAX_AMOSTRAS, len(matriz))
+        )
+        modelo.fit(matriz)
+        scores = modelo.score_samples(matriz)
+        return scores, np.where(scores < modelo.offset_, -1, 1)
     
-    def _calcular_estatisticas(self, valores: np.ndarray) -> Dict[str, float]:
-        """Calcula estatísticas descritivas dos valores"""
-        return {
-            'media': float(np.mean(valores)),
-            'mediana': float(np.median(valores)),
-            'desvio_padrao': float(np.std(valores)),
-            'minimo': float(np.min(valores)),
-            'maximo': float(np.max(valores)),
-            'q1': float(np.percentile(valores, 25)),
-            'q3': float(np.percentile(valores, 75)),
-            'iqr': float(np.percentile(valores, 75) - np.percentile(valores, 25))
+    def _pontuar_iqr(self, valores: np.ndarray, stats: Dict[str, float]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Pontua as cargas pela regra do IQR (fora de Q1 - 1.5*IQR / Q3 + 1.5*IQR).
+        
+        Returns:
+            (scores, predicoes) no mesmo padrão de _pontuar: o score é a
+            distância além da cerca, negativa (0 para quem está dentro)
+        """
+        limite_inferior = stats['q1'] - (1.5 * stats['iqr'])
+        limite_superior = stats['q3'] + (1.5 * stats['iqr'])
+        excesso = np.maximum(valores - limite_superior, limite_inferior - valores)
+        excesso = np.maximum(excesso, 0)
+        
+        # Distância em unidades de IQR; com os quartis colapsados (IQR zero),
+        # relativa à mediana; se ela também for zero, no próprio valor
+        escala = stats['iqr'] or abs(stats['mediana']) or 1.0
+        scores = -excesso / escala
+        return scores, np.where(excesso > 0, -1, 1)
+    
+    def _sem_variacao(self, stats: Dict[str, float]) -> bool:
+        """Valores constantes ou com variação relativa (desvio/média) desprezível"""
+        desvio = stats['desvio_padrao']
+        return desvio == 0 or desvio < VARIACAO_MINIMA * abs(stats['media'])
+    
+    def _n_estimadores(self, n_cargas: int) -> int:
+        """Número de árvores proporcional ao lote (poucas cargas não pedem 100 árvores)"""
+        return min(N_ESTIMADORES_MAX, max(N_ESTIMADORES_MIN, n_cargas // 2))
+    
+    def _calcular_estatisticas(self, valores: np.ndarray) -> Tuple[Dict[str, int], Dict[str, float]]:
+        """
+        Calcula estatísticas descritivas dos valores
+        
+        Returns:
+            (estatisticas, brutas): as truncadas em int para a resposta e
+            as mesmas em float, para os cálculos
+        """
+        # Os três quantis saem de uma única partição do array
+        q1, mediana, q3 = np.percentile(valores, [25, 50, 75])
+        brutas = {
+            'media': float(valores.mean()),
+            'mediana': float(mediana),
+            'desvio_padrao': float(valores.std()),
+            'minimo': float(valores.min()),
+            'maximo': float(valores.max()),
+            'q1': float(q1),
+            'q3': float(q3),
+            'iqr': float(q3 - q1)
         }
+        return {chave: int(valor) for chave, valor in brutas.items()}, brutas
     
     def _classificar_anomalia(self, valor: float, stats: Dict[str, float]) -> str:
-        """Classifica o tipo de anomalia baseado nas estatísticas"""
+        """Classifica o tipo de anomalia"""
         if valor > stats['q3'] + (1.5 * stats['iqr']):
             if valor > stats['media'] * 2:
                 return 'MUITO_ALTO'
@@ -110,86 +293,109 @@ class DetectorAnomalias:
             return 'BAIXO'
         return 'OUTLIER'
     
-    def _calcular_severidade(self, score: float, todos_scores: np.ndarray) -> int:
+    def _calcular_severidades(self, scores: np.ndarray) -> np.ndarray:
+        """Calcula severidade de 0-100 (100 = mais suspeito) para todos os scores"""
+        min_score = scores.min()
+        max_score = scores.max()
+        
+        if max_score == min_score:
+            return np.full(scores.shape, 50, dtype=int)
+        
+        # Inverter: scores mais negativos = maior severidade
+        severidades = 100 - ((scores - min_score) / (max_score - min_score) * 100)
+        return severidades.astype(int)
+    
+    def _calcular_severidades_iqr(self, scores: np.ndarray) -> np.ndarray:
         """
-        Calcula severidade de 0-100 (100 = mais suspeito)
-        Baseado em quão isolado o valor está
+        Severidade de 50-100 para as cargas fora das cercas do IQR: 50 logo
+        além da cerca, 100 para a mais distante
         """
-        # Normalizar score para 0-100
-        min_score = np.min(todos_scores)
-        max_score = np.max(todos_scores)
+        excesso = -scores
+        max_excesso = excesso.max()
         
-        if max_score == min_score:
-            return 50
+        if max_excesso == 0:
+            return np.full(scores.shape, 50, dtype=int)
         
-        # Inverter: scores mais negativos = mais anômalos = maior severidade
-        severidade = 100 - ((score - min_score) / (max_score - min_score) * 100)
-        return int(severidade)
+        severidades = 50 + (excesso / max_excesso * 50)
+        return severidades.astype(int)
     
-    def _gerar_sugestao(self, valor: float, stats: Dict[str, float], tipo: str) -> str:
-        """Gera sugestão de ação baseada no tipo de anomalia"""
-        sugestoes = {
-            'MUITO_ALTO': f"Valor {valor:,.0f} está muito acima da média ({stats['media']:,.0f}). Verifique se não há zeros extras.",
-            'ALTO': f"Valor {valor:,.0f} está acima do esperado ({stats['mediana']:,.0f}). Confirme se está correto.",
-            'MUITO_BAIXO': f"Valor {valor:,.0f} está muito abaixo da média ({stats['media']:,.0f}). Verifique se não faltam dígitos.",
-            'BAIXO': f"Valor {valor:,.0f} está abaixo do esperado ({stats['mediana']:,.0f}). Confirme se está correto.",
-            'OUTLIER': f"Valor {valor:,.0f} é incomum. Valor típico é ¥{stats['mediana']:,.0f}."
+    def _formatar_referencias(self, stats: Dict[str, float]) -> Dict[str, str]:
+        """Formata média e mediana uma única vez por análise"""
+        return {
+            'media': f"¥{stats['media']:,.0f}",
+            'mediana': f"¥{stats['mediana']:,.0f}"
         }
-        return sugestoes.get(tipo, "Verifique este valor.")
+    
+    def _gerar_sugestao(self, valor: float, referencias: Dict[str, str], tipo: str) -> str:
+        """Gera sugestão de ação"""
+        texto = SUGESTOES.get(tipo)
+        if texto is None:
+            return "Verifique este valor."
+        return texto.format(valor=f"¥{valor:,.0f}", **referencias)
 
 
 class DetectorAnomaliasPorCliente:
-    """
-    Detector que considera histórico do cliente
-    """
+    """Detector que considera histórico do cliente"""
     
-    def __init__(self):
-        self.detector_base = DetectorAnomalias()
+    def __init__(self, backend=BACKEND_SKLEARN, limite_ajustes: Optional[threading.Semaphore] = None):
+        self.detector_base = DetectorAnomalias(backend=backend, limite_ajustes=limite_ajustes)
     
     def analisar_com_historico(
         self, 
         cargas_atuais: List[Dict[str, Any]], 
         historico_cliente: List[Dict[str, Any]] = None
     ) -> Dict[str, Any]:
-        """
-        Analisa cargas considerando histórico do cliente
-        """
-        # Análise básica das cargas atuais
+        """Analisa cargas considerando histórico do cliente"""
+        # Análise básica
         resultado_atual = self.detector_base.analisar_cargas(cargas_atuais)
         
-        # Se tiver histórico, fazer comparação adicional
+        # Se tiver histórico suficiente, fazer comparação adicional
         if historico_cliente and len(historico_cliente) >= 10:
-            valores_historicos = [float(h.get('CARGAS_VALOR', 0)) for h in historico_cliente]
-            stats_historico = {
-                'media_historica': np.mean(valores_historicos),
-                'mediana_historica': np.median(valores_historicos),
-                'max_historico': np.max(valores_historicos),
-                'min_historico': np.min(valores_historicos)
-            }
-            
-            # Verificar se valores atuais estão muito fora do histórico
-            for carga in cargas_atuais:
-                valor = float(carga.get('CARGAS_VALOR', 0))
+            try:
+                valores_historicos = np.fromiter(
+                    (float(h.get('CARGAS_VALOR', 0) or 0) for h in historico_cliente),
+                    dtype=np.float64,
+                    count=len(historico_cliente)
+                )
+                stats_historico = {
+                    'media_historica': int(valores_historicos.mean()),
+                    'mediana_historica': int(np.median(valores_historicos)),
+                    'max_historico': int(valores_historicos.max()),
+                    'min_historico': int(valores_historicos.min())
+                }
+                
+                # IDs já detectados, para checagem O(1)
+                detectados_ids = {a['id'] for a in resultado_atual['anomalias']}
                 
-                # Se valor atual é 2x maior que máximo histórico
-                if valor > stats_historico['max_historico'] * 2:
-                    # Adicionar como anomalia se ainda não foi detectado
-                    ja_detectado = any(
-                        a['id'] == carga.get('ID_CARGAS') 
-                        for a in resultado_atual['anomalias']
-                    )
+                # Verificar valores muito fora do histórico:
+                # valor 2x maior que máximo histórico
+                valores_atuais = np.fromiter(
+                    (float(c.get('CARGAS_VALOR', 0) or 0) for c in cargas_atuais),
+                    dtype=np.float64,
+                    count=len(cargas_atuais)
+                )
+                limite = stats_historico['max_historico'] * 2
+                
+                for i in np.flatnonzero(valores_atuais > limite):
+                    carga = cargas_atuais[i]
+                    valor = float(valores_atuais[i])
+                    id_carga = carga.get('ID_CARGAS')
                     
-                    if not ja_detectado:
+                    if id_carga not in detectados_ids:
+                        detectados_ids.add(id_carga)
                         resultado_atual['anomalias'].append({
-                            'id': carga.get('ID_CARGAS'),
-                            'veiculo': carga.get('CARGAS_VEICULO'),
+                            'id': id_carga,
+                            'veiculo': carga.get('CARGAS_VEICULO', 'N/A'),
                             'valor': valor,
                             'tipo': 'FORA_DO_HISTORICO',
                             'severidade': 90,
                             'sugestao': f"Valor ¥{valor:,.0f} é 2x maior que máximo histórico (¥{stats_historico['max_historico']:,.0f})",
                             'valor_esperado': stats_historico['media_historica']
                         })
-            
-            resultado_atual['comparacao_historico'] = stats_historico
+                
+                resultado_atual['comparacao_historico'] = stats_historico
+                
+            except Exception as e:
+                logger.error("Erro ao processar histórico: %s", e)
         
-        return resultado_atual
\ No newline at end of file
+        return resultado_atual
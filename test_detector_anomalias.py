@@ -0,0 +1,64 @@
+"""
+Testes do DetectorAnomalias - caminho da regra do IQR
+(lotes pequenos ou sem variação)
+"""
+
+import unittest
+
+from detector_anomalias import DetectorAnomalias, MIN_CARGAS_MODELO
+
+
+def montar_cargas(valores):
+    """Monta a lista de cargas no formato recebido pela API"""
+    return [
+        {'ID_CARGAS': i, 'CARGAS_VEICULO': f'Veiculo {i}', 'CARGAS_VALOR': valor}
+        for i, valor in enumerate(valores, 1)
+    ]
+
+
+class TestRegraIQR(unittest.TestCase):
+
+    def setUp(self):
+        self.detector = DetectorAnomalias(contaminacao=0.15)
+
+    def test_lote_pequeno_usa_iqr(self):
+        valores = [float(v) for v in range(100, 112)] + [500.0]
+        resultado = self.detector.analisar_cargas(montar_cargas(valores))
+
+        self.assertLess(len(valores), MIN_CARGAS_MODELO)
+        self.assertEqual(resultado['metodo'], 'iqr')
+        self.assertEqual([a['id'] for a in resultado['anomalias']], [13])
+        self.assertEqual(resultado['anomalias'][0]['tipo'], 'MUITO_ALTO')
+
+    def test_valores_constantes_com_centavos_sem_anomalias(self):
+        resultado = self.detector.analisar_cargas(montar_cargas([10.5] * 5))
+
+        self.assertEqual(resultado['metodo'], 'iqr')
+        self.assertEqual(resultado['anomalias'], [])
+        self.assertEqual(resultado['total_anomalias'], 0)
+
+    def test_lote_grande_constante_usa_iqr(self):
+        resultado = self.detector.analisar_cargas(montar_cargas([45000.0] * 40))
+
+        self.assertEqual(resultado['metodo'], 'iqr')
+        self.assertEqual(resultado['anomalias'], [])
+
+    def test_lote_grande_com_variacao_usa_isolation_forest(self):
+        valores = [float(40000 + (i % 10) * 500) for i in range(40)]
+        resultado = self.detector.analisar_cargas(montar_cargas(valores))
+
+        self.assertEqual(resultado['metodo'], 'isolation_forest_sklearn')
+
+    def test_severidade_das_anomalias_iqr(self):
+        # Cercas em 93.5 e 119.5: 120 fica logo além, 500 bem longe
+        valores = [float(v) for v in range(100, 112)] + [120.0, 500.0]
+        resultado = self.detector.analisar_cargas(montar_cargas(valores))
+
+        severidades = {a['valor']: a['severidade'] for a in resultado['anomalias']}
+        self.assertEqual(set(severidades), {120.0, 500.0})
+        self.assertEqual(severidades[500.0], 100)
+        self.assertEqual(severidades[120.0], 50)
+
+
+if __name__ == '__main__':
+    unittest.main()